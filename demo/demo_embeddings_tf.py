@@ -7,19 +7,35 @@ from __future__ import print_function
 import prettytensor as pt
 import tensorflow as tf
 import numpy as np
-import scipy.misc
+import cv2
 import os
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image, ImageDraw, ImageFont
 import re
+import threading
 
 from misc.config import cfg, cfg_from_file
 from misc.utils import mkdir_p
 from stageII.model import CondGAN
 
-from embedding.model import Model
+from embedding.model import Model, TRTModel
 from embedding.preprocessing import normalize
 
+# libjpeg-turbo SIMD encoder is used when PyTurboJPEG is installed
+try:
+    from turbojpeg import TurboJPEG, TJSAMP_420
+    JPEG = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    JPEG = None
+
+# same quality (PIL's default) and 4:2:0 chroma subsampling (OpenCV's)
+# whichever encoder is used
+JPEG_QUALITY = 75
+
+# caption font is parsed on first use and shared by all captions
+FONT = None
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Train a GAN network')
@@ -36,6 +52,9 @@ def parse_args():
     parser.add_argument('--caption_model', type=str, default=None,
                         help='Path to the file with embedding model')
 
+    parser.add_argument('--caption_engine', type=str, default=None,
+                        help='Path to the TensorRT engine of embedding model')
+
     parser.add_argument('--save_dir', type=str, default=None,
                         help='Path to output saved images')
     args = parser.parse_args()
@@ -58,7 +77,7 @@ def sample_encoded_context(embeddings, model, bAugmentation=True):
     return c
 
 
-def build_model(sess, embedding_dim, batch_size, cfg):
+def build_model(sess, embedding_dim, cfg):
     '''
     Builds model
     '''
@@ -68,19 +87,34 @@ def build_model(sess, embedding_dim, batch_size, cfg):
         lr_imsize=cfg.TEST.LR_IMSIZE,
         hr_lr_ratio=hr_lr_ratio)
 
-    embeddings = tf.placeholder(
-        tf.float32, [batch_size, embedding_dim],
+    # embeddings are uploaded once per batch of captions into a variable
+    # kept on the device, and tiled there to draw several samples per run
+    embeddings_holder = tf.placeholder(
+        tf.float32, [None, embedding_dim],
         name='conditional_embeddings')
+    embeddings_var = tf.Variable(
+        embeddings_holder, trainable=False, collections=[],
+        validate_shape=False, name='conditional_embeddings_var')
+    num_samples = tf.placeholder_with_default(1, [], name='num_samples')
+    embeddings = tf.tile(
+        tf.reshape(embeddings_var, [-1, embedding_dim]),
+        tf.pack([num_samples, 1]))
 
     with pt.defaults_scope(phase=pt.Phase.test):
         with tf.variable_scope("g_net"):
             c = sample_encoded_context(embeddings, model)
-            z = tf.random_normal([batch_size, cfg.Z_DIM])
+            z = tf.random_normal(tf.pack([tf.shape(embeddings)[0], cfg.Z_DIM]))
             fake_images = model.get_generator(tf.concat(1, [c, z]))
         with tf.variable_scope("hr_g_net"):
+            # not shared with g_net: hr_g_net has its own conditioning
+            # augmentation weights in the checkpoint
             hr_c = sample_encoded_context(embeddings, model)
             hr_fake_images = model.hr_get_generator(fake_images, hr_c)
 
+    # stage I images upsampled to stage II resolution for side by side display
+    up_fake_images = tf.image.resize_bilinear(
+        fake_images, [cfg.TEST.HR_IMSIZE, cfg.TEST.HR_IMSIZE])
+
     ckt_path = cfg.TEST.PRETRAINED_MODEL
     if ckt_path.find('.ckpt') != -1:
         print("Reading model parameters from %s" % ckt_path)
@@ -88,13 +122,17 @@ def build_model(sess, embedding_dim, batch_size, cfg):
         saver.restore(sess, ckt_path)
     else:
         print("Input a valid model path. %s is not valid" % ckt_path)
-    return embeddings, fake_images, hr_fake_images
+    return (embeddings_holder, embeddings_var.initializer, num_samples,
+            up_fake_images, hr_fake_images)
 
 
 def drawCaption(img, caption):
+    global FONT
     img_txt = Image.fromarray(img)
     # get a font
-    fnt = ImageFont.truetype('Pillow/Tests/fonts/FreeMono.ttf', 50)
+    if FONT is None:
+        FONT = ImageFont.truetype('Pillow/Tests/fonts/FreeMono.ttf', 50)
+    fnt = FONT
     # get a drawing context
     d = ImageDraw.Draw(img_txt)
 
@@ -116,81 +154,98 @@ def drawCaption(img, caption):
     return img_txt
 
 
+def save_image(fullpath, img):
+    '''Encodes RGB image as JPEG and writes it to fullpath'''
+    img = cv2.cvtColor(np.asarray(img), cv2.COLOR_RGB2BGR)
+    if JPEG is not None:
+        with open(fullpath, 'wb') as f:
+            f.write(JPEG.encode(
+                img, quality=JPEG_QUALITY, jpeg_subsample=TJSAMP_420))
+    elif not cv2.imwrite(fullpath, img, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY]):
+        raise IOError('Could not write image: %s' % fullpath)
+
+
+def to_uint8(images):
+    '''Maps generator outputs from [-1, 1] to uint8 pixels'''
+    pixels = np.multiply(images, 127.5, dtype=np.float32)
+    pixels += 127.5
+    np.clip(pixels, 0, 255, out=pixels)
+    return pixels.astype(np.uint8)
+
+
 def save_super_images(lr_sample_batchs, hr_sample_batchs,
                       texts_batch, batch_size,
-                      startID, save_dir=None):
+                      startID, save_dir=None, executor=None):
 
     if save_dir and not os.path.isdir(save_dir):
         print('Make a new folder: ', save_dir)
         mkdir_p(save_dir)
 
     # Save up to 16 samples for each text embedding/sentence
-    img_shape = hr_sample_batchs[0][0].shape
+    # laid out in blocks of 8: stage I row above stage II row
+    lr_images = to_uint8(lr_sample_batchs)
+    hr_images = to_uint8(hr_sample_batchs)
+    num_samples = len(lr_images)
+    height, width = hr_images.shape[2:4]
+    top, mid = 128, 64
+    block_height = 2 * height + mid
+
+    canvas_height = top + 2 * height
+    if num_samples > 8:
+        canvas_height += block_height
+    canvas_width = (1 + np.minimum(8, num_samples)) * width
+
+    # drawCaption copies the canvas into a new image, so it is reused
+    canvas = np.empty((canvas_height, canvas_width, 3), dtype=np.uint8)
     super_images = []
+    # pending writes, their results have to be checked by the caller
+    futures = []
     for j in range(batch_size):
         if not re.search('[a-zA-Z]+', texts_batch[j]):
             continue
 
-        padding = 255 + np.zeros(img_shape)
-        row1 = [padding]
-        row2 = [padding]
-        # First row with up to 8 samples
-        for i in range(np.minimum(8, len(lr_sample_batchs))):
-            lr_img = lr_sample_batchs[i][j]
-            hr_img = hr_sample_batchs[i][j]
-            hr_img = (hr_img + 1.0) * 127.5
-            re_sample = scipy.misc.imresize(lr_img, hr_img.shape[:2])
-            row1.append(re_sample)
-            row2.append(hr_img)
-        row1 = np.concatenate(row1, axis=1)
-        row2 = np.concatenate(row2, axis=1)
-        superimage = np.concatenate([row1, row2], axis=0)
-
-        # Second 8 samples with up to 8 samples
-        if len(lr_sample_batchs) > 8:
-            row1 = [padding]
-            row2 = [padding]
-            for i in range(8, len(lr_sample_batchs)):
-                lr_img = lr_sample_batchs[i][j]
-                hr_img = hr_sample_batchs[i][j]
-                hr_img = (hr_img + 1.0) * 127.5
-                re_sample = scipy.misc.imresize(lr_img, hr_img.shape[:2])
-                row1.append(re_sample)
-                row2.append(hr_img)
-            row1 = np.concatenate(row1, axis=1)
-            row2 = np.concatenate(row2, axis=1)
-            super_row = np.concatenate([row1, row2], axis=0)
-            superimage2 = np.zeros_like(superimage)
-            superimage2[:super_row.shape[0],
-                        :super_row.shape[1],
-                        :super_row.shape[2]] = super_row
-            mid_padding = np.zeros((64, superimage.shape[1], 3))
-            superimage =\
-                np.concatenate([superimage, mid_padding, superimage2], axis=0)
-
-        top_padding = 255 + np.zeros((128, superimage.shape[1], 3))
-        superimage =\
-            np.concatenate([top_padding, superimage], axis=0)
+        canvas.fill(255)
+        # Second block is black apart from its padding column and samples
+        if num_samples > 8:
+            canvas[top + 2 * height:] = 0
+            canvas[top + block_height:, :width] = 255
+
+        for i in range(num_samples):
+            y = top + (i // 8) * block_height
+            x = (1 + i % 8) * width
+            canvas[y:y + height, x:x + width] = lr_images[i, j]
+            canvas[y + height:y + 2 * height, x:x + width] = hr_images[i, j]
 
         fullpath = '%s/sentence%d.jpg' % (save_dir, startID + j)
-        superimage = drawCaption(np.uint8(superimage), texts_batch[j])
+        superimage = drawCaption(canvas, texts_batch[j])
         if save_dir:
-            scipy.misc.imsave(fullpath, superimage)
+            # encoding in the executor overlaps with generating next batch
+            if executor is not None:
+                futures.append(executor.submit(save_image, fullpath, superimage))
+            else:
+                save_image(fullpath, superimage)
         super_images.append(superimage)
 
-    return super_images
+    return super_images, futures
 
 
 def load_texts(texts_path):
+    '''Yields lines of the file without reading it all at once'''
     with open(texts_path, 'rt') as f:
-        texts = f.readlines()
-    return texts
+        for line in f:
+            yield line
 
 
-def embed_text(texts, model):
+def embed_text(texts, model, batch_size=256):
     normalized_texts = [normalize(text) for text in texts]
-    embeddings = model.embed(normalized_texts)
     num_embeddings = len(normalized_texts)
+    if num_embeddings <= 0:
+        raise ValueError('At least one embedding required')
+
+    # embedding in batches bounds memory used by a single forward pass
+    embeddings = np.concatenate([
+        model.embed(normalized_texts[start:start + batch_size])
+        for start in range(0, num_embeddings, batch_size)])
 
     print('Total number of sentences:', num_embeddings)
     print('num_embeddings:', num_embeddings, embeddings.shape)
@@ -203,31 +258,77 @@ class GenerativeModel(object):
         config = tf.ConfigProto(allow_soft_placement=True)
         self.persistent_sess = tf.Session(config=config)
         self.batch_size = batch_size
+        # largest number of images generated by a single run
+        self.max_batch_size = np.maximum(batch_size, cfg.TEST.BATCH_SIZE)
         with tf.device("/gpu:%d" % cfg.GPU_ID):
-            self.embeddings_holder, self.fake_images_opt, self.hr_fake_images_opt =\
-                build_model(self.persistent_sess, embedding_dim, self.batch_size, cfg)
+            self.embeddings_holder, self.embeddings_upload, self.num_samples,\
+                self.up_fake_images_opt, self.hr_fake_images_opt =\
+                build_model(self.persistent_sess, embedding_dim, cfg)
+        # session runs release the GIL, so two of them can be in flight
+        self.executor = ThreadPoolExecutor(max_workers=2)
+        # embeddings live in a single session variable, callers uploading
+        # and sampling them must not interleave (e.g. webapp requests)
+        self.lock = threading.Lock()
 
     def __del__(self):
+        self.executor.shutdown()
         self.persistent_sess.close()
 
-    def generate(self, embeddings):
+    def set_embeddings(self, embeddings):
+        '''
+        Uploads embeddings to the device, once per batch of captions
+        Hold `self.lock` until the samples drawn from them are fetched
+        '''
+        self.persistent_sess.run(
+            self.embeddings_upload,
+            feed_dict={
+                self.embeddings_holder: embeddings
+            })
+
+    def sample(self, n=1):
+        '''Draws n samples for every embedding already on the device'''
         hr_samples, lr_samples =\
             self.persistent_sess.run(
-                [self.hr_fake_images_opt, self.fake_images_opt],
+                [self.hr_fake_images_opt, self.up_fake_images_opt],
                 feed_dict={
-                    self.embeddings_holder: embeddings
+                    self.num_samples: n
                 })
 
         return hr_samples, lr_samples
 
-    def generate_n(self, embeddings, n=8):
-        lr_samples_batchs = []
-        hr_samples_batchs = []
+    def generate(self, embeddings):
+        with self.lock:
+            self.set_embeddings(embeddings)
+            return self.sample()
 
-        for i in range(np.minimum(16, n)):
-            hr_samples, samples = self.generate(embeddings)
-            lr_samples_batchs.append(samples)
-            hr_samples_batchs.append(hr_samples)
+    def generate_n(self, embeddings, n=8):
+        n = np.minimum(16, n)
+        batch_size = len(embeddings)
+
+        # draw as many of the n samples per run as `max_batch_size` allows
+        samples_per_run = np.maximum(1, self.max_batch_size // batch_size)
+        with self.lock:
+            self.set_embeddings(embeddings)
+            if 1 < samples_per_run < n:
+                # two runs in flight overlap copies back from one with
+                # computing the other, each gets half of `max_batch_size`
+                samples_per_run //= 2
+                runs = [
+                    self.executor.submit(
+                        self.sample, np.minimum(samples_per_run, n - start))
+                    for start in range(0, n, samples_per_run)]
+                samples = [run.result() for run in runs]
+            else:
+                samples = [
+                    self.sample(np.minimum(samples_per_run, n - start))
+                    for start in range(0, n, samples_per_run)]
+        hr_samples, lr_samples = zip(*samples)
+        hr_samples = np.concatenate(hr_samples)
+        lr_samples = np.concatenate(lr_samples)
+
+        # (n * batch_size, H, W, 3) --> (n, batch_size, H, W, 3)
+        hr_samples_batchs = hr_samples.reshape((n, batch_size) + hr_samples.shape[1:])
+        lr_samples_batchs = lr_samples.reshape((n, batch_size) + lr_samples.shape[1:])
 
         return hr_samples_batchs, lr_samples_batchs
 
@@ -246,16 +347,19 @@ if __name__ == "__main__":
     texts = load_texts(args.caption_path)
 
     print('Loading embedding model')
-    model = Model(
-        os.path.join(args.caption_model, 'frozen_model.pb'),
-        os.path.join(args.caption_model, 'tokenizer.pickle')
-    )
+    if args.caption_engine is not None:
+        model = TRTModel(
+            args.caption_engine,
+            os.path.join(args.caption_model, 'tokenizer.pickle')
+        )
+    else:
+        model = Model(
+            os.path.join(args.caption_model, 'frozen_model.pb'),
+            os.path.join(args.caption_model, 'tokenizer.pickle')
+        )
 
     embeddings, num_embeddings, normalized_texts = embed_text(texts, model)
 
-    if num_embeddings <= 0:
-        raise ValueError('At least one embedding required')
-
     # set batchs size
     batch_size = np.minimum(num_embeddings, cfg.TEST.BATCH_SIZE)
 
@@ -266,26 +370,36 @@ if __name__ == "__main__":
     save_dir = args.save_dir if args.save_dir else os.path.dirname(
         args.caption_path)
 
-    count = 0
-    while count < num_embeddings:
-        # generate batches
-        iend = count + batch_size
-        if iend > num_embeddings:
-            iend = num_embeddings
-            count = num_embeddings - batch_size
-        embeddings_batch = embeddings[count:iend]
-        text_batch = normalized_texts[count:iend]
-
-        # sample images
-        hr_samples_batch, lr_samples_batch = model.generate_n(embeddings_batch)
-        super_images = save_super_images(
-            lr_samples_batch,
-            hr_samples_batch,
-            text_batch,
-            batch_size,
-            startID=count, save_dir=save_dir)
-
-        count += batch_size
+    pending = []
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        count = 0
+        while count < num_embeddings:
+            # generate batches
+            iend = count + batch_size
+            if iend > num_embeddings:
+                iend = num_embeddings
+                count = num_embeddings - batch_size
+            embeddings_batch = embeddings[count:iend]
+            text_batch = normalized_texts[count:iend]
+
+            # sample images
+            hr_samples_batch, lr_samples_batch = model.generate_n(embeddings_batch)
+
+            # wait for the previous batch's writes so they don't pile up,
+            # this also re-raises errors from writing them
+            for future in pending:
+                future.result()
+            super_images, pending = save_super_images(
+                lr_samples_batch,
+                hr_samples_batch,
+                text_batch,
+                batch_size,
+                startID=count, save_dir=save_dir, executor=executor)
+
+            count += batch_size
+
+        for future in pending:
+            future.result()
 
     print('Finish generating samples for %d sentences:' % num_embeddings)
     print('Example sentences:')
@@ -28,7 +28,7 @@ def my_form_post():
     text = request.form['text'].lower()
     embeddings, num_embeddings, normalized_texts = embed_text([str(text)], text_model)
     hr_imgs, lr_imgs = img_model.generate_n(embeddings, n=NUM_IMGS)
-    imgs = save_super_images(lr_imgs, hr_imgs, normalized_texts, 1, startID=0)
+    imgs, _ = save_super_images(lr_imgs, hr_imgs, normalized_texts, 1, startID=0)
 
     print('Generated: %d images' % len(hr_imgs))
     strIO = StringIO.StringIO()
@@ -0,0 +1,112 @@
+"""
+This module converts a frozen embedding graph into a TensorRT engine
+
+Usage: engine.py MODEL_DIR [options]
+
+Arguments:
+    MODEL_DIR   directory with `frozen_model.pb` created by `graph.py`
+
+Options:
+    -l, --sent-length=<int>     Maximum number of words in the sentence
+                                [default: 70]
+    -o, --opt-batch=<int>       Batch size the engine is tuned for
+                                [default: 32]
+    -m, --max-batch=<int>       Largest batch the engine accepts
+                                [default: 64]
+    --fp32                      Build the engine without FP16 kernels
+
+Requires `tf2onnx` and TensorRT's `trtexec` to be available.
+
+Example:
+> python embedding/engine.py /models/fashion
+"""
+import os
+import sys
+import subprocess
+import logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s [%(levelname)s] %(message)s',)
+
+import tensorflow as tf
+from docopt import docopt
+
+from model import INPUT_TENSOR_NAME, OUTPUT_TENSOR_NAME, LEARNING_PAHSE
+
+
+def strip_learning_phase(graph_def,
+                         output_tensor_name=OUTPUT_TENSOR_NAME,
+                         learning_phase=LEARNING_PAHSE):
+    '''
+    Replaces keras learning phase placeholder with a constant
+    so the exported graph has a single input
+    '''
+    with tf.Graph().as_default() as graph:
+        phase = tf.constant(False, name='inference_phase')
+        tf.import_graph_def(graph_def, input_map={learning_phase: phase}, name='')
+
+    output_node = output_tensor_name.split(':')[0]
+    return tf.graph_util.extract_sub_graph(graph.as_graph_def(), [output_node])
+
+
+def export_inference_graph(model_dir):
+    '''
+    Saves `frozen_model.pb` without learning phase as `inference_model.pb`
+    '''
+    logger = logging.getLogger(__name__)
+
+    frozen_graph = os.path.join(model_dir, 'frozen_model.pb')
+    inference_graph = os.path.join(model_dir, 'inference_model.pb')
+
+    with tf.gfile.GFile(frozen_graph, 'rb') as f:
+        graph_def = tf.GraphDef()
+        graph_def.ParseFromString(f.read())
+
+    logger.info("Saving inference graph to: %s" % inference_graph)
+    with tf.gfile.GFile(inference_graph, 'wb') as f:
+        f.write(strip_learning_phase(graph_def).SerializeToString())
+
+    return inference_graph
+
+
+def build(model_dir, maxlen, opt_batch, max_batch, fp16=True):
+    '''
+    Converts `frozen_model.pb` to ONNX and builds serialized engine `model.plan`
+    '''
+    logger = logging.getLogger(__name__)
+
+    inference_graph = export_inference_graph(model_dir)
+    onnx_model = os.path.join(model_dir, 'model.onnx')
+    engine = os.path.join(model_dir, 'model.plan')
+
+    logger.info("Converting graph to: %s" % onnx_model)
+    subprocess.check_call([
+        sys.executable, '-m', 'tf2onnx.convert',
+        '--input', inference_graph,
+        '--inputs', INPUT_TENSOR_NAME,
+        '--outputs', OUTPUT_TENSOR_NAME,
+        '--output', onnx_model])
+
+    # tensor names contain ':' so they have to be quoted for trtexec
+    shape = "'%s':%%ix%i" % (INPUT_TENSOR_NAME, maxlen)
+    command = [
+        'trtexec',
+        '--onnx=%s' % onnx_model,
+        '--saveEngine=%s' % engine,
+        '--minShapes=%s' % (shape % 1),
+        '--optShapes=%s' % (shape % opt_batch),
+        '--maxShapes=%s' % (shape % max_batch)]
+    if fp16:
+        command.append('--fp16')
+
+    logger.info("Building engine: %s" % engine)
+    subprocess.check_call(command)
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__, version='text')
+    build(args['MODEL_DIR'],
+          int(args['--sent-length']),
+          int(args['--opt-batch']),
+          int(args['--max-batch']),
+          not args['--fp32'])
@@ -5,6 +5,7 @@ It is used to embed sequences of texts
 import numpy as np
 import tensorflow as tf
 import pickle
+import string
 
 from keras.preprocessing.sequence import pad_sequences
 
@@ -36,32 +37,133 @@ class Model(object):
         self.Y = self.graph.get_tensor_by_name("%s/%s" % (PREFIX, output_tensor_name))
         self.LF = self.graph.get_tensor_by_name("%s/%s" % (PREFIX, learning_phase))
 
-        self.tokenizer = pickle.load(open(tokenizer_path, 'rb'))
+        self.load_tokenizer(tokenizer_path)
         self.persistent_sess = tf.Session(graph=self.graph)
 
         self.maxlen = maxlen
 
+    def load_tokenizer(self, tokenizer_path):
+        ''' loads keras tokenizer and precomputes its lookups '''
+        self.tokenizer = pickle.load(open(tokenizer_path, 'rb'))
+
+        # words dropped by the tokenizer are left out of the lookup table
+        num_words = self.tokenizer.num_words
+        self.vocabulary = {
+            word: index for word, index in self.tokenizer.word_index.items()
+            if not num_words or index < num_words
+        }
+
+        filters, split = self.tokenizer.filters, self.tokenizer.split
+        self.str_filters = string.maketrans(filters, split * len(filters))
+        self.unicode_filters = dict((ord(c), unicode(split)) for c in filters)
+
     def embed(self, texts):
         ''' use model to find prediction '''
+        return self.predict(self.tokenize(texts))
+
+    def tokenize(self, texts):
+        ''' turns texts into padded sequences of word indices '''
         # our graph expect tensors of shape '(?, 1)'
         if not isinstance(texts, (list, tuple)):
             texts = [texts]
 
-        sequences = self.tokenizer.texts_to_sequences(texts)
+        sequences = [self.text_to_sequence(text) for text in texts]
 
-        # Padding data
+        # Padding data, already an array of shape (len(texts), maxlen)
         data = pad_sequences(
             sequences,
             maxlen=self.maxlen,
+            dtype='int32',
             padding='post',
             truncating='post')
 
-        data = np.array(data).reshape(-1, self.maxlen)
+        return data
+
+    def text_to_sequence(self, text):
+        ''' same as `tokenizer.texts_to_sequences` using precomputed lookups '''
+        if self.tokenizer.lower:
+            text = text.lower()
+        if isinstance(text, unicode):
+            text = text.translate(self.unicode_filters)
+        else:
+            text = text.translate(self.str_filters)
+
+        vocabulary = self.vocabulary
+        return [vocabulary[word] for word in text.split(self.tokenizer.split)
+                if word in vocabulary]
 
-        # feed data through graph
+    def predict(self, data):
+        ''' feeds padded sequences through the graph '''
         h = self.persistent_sess.run(self.Y, feed_dict={
             self.X: data,
             self.LF: False
         })
 
         return h
+
+
+class TRTModel(Model):
+    '''
+    Runs the embedding network as a TensorRT engine built with `engine.py`
+    '''
+
+    def __init__(self, engine_path, tokenizer_path, maxlen=MAX_LEN):
+        # TensorRT and pycuda are only required by this backend
+        import pycuda.autoinit  # noqa: creates the CUDA context
+        import pycuda.driver as cuda
+        import tensorrt as trt
+
+        print('Loading the engine')
+        runtime = trt.Runtime(trt.Logger(trt.Logger.WARNING))
+        with open(engine_path, 'rb') as f:
+            self.engine = runtime.deserialize_cuda_engine(f.read())
+        self.context = self.engine.create_execution_context()
+        self.stream = cuda.Stream()
+        self.cuda = cuda
+
+        self.load_tokenizer(tokenizer_path)
+        self.maxlen = maxlen
+
+        # binding order is up to the engine, not the order of the graph
+        bindings = range(self.engine.num_bindings)
+        self.input_index = next(
+            i for i in bindings if self.engine.binding_is_input(i))
+        self.output_index = next(
+            i for i in bindings if not self.engine.binding_is_input(i))
+
+        # buffers are allocated once for the largest batch the engine accepts
+        _, _, max_shape = self.engine.get_profile_shape(0, self.input_index)
+        self.max_batch = max_shape[0]
+        output_dim = self.engine.get_binding_shape(self.output_index)[-1]
+
+        self.h_input = cuda.pagelocked_empty(
+            (self.max_batch, maxlen),
+            trt.nptype(self.engine.get_binding_dtype(self.input_index)))
+        self.h_output = cuda.pagelocked_empty(
+            (self.max_batch, output_dim),
+            trt.nptype(self.engine.get_binding_dtype(self.output_index)))
+        self.d_input = cuda.mem_alloc(self.h_input.nbytes)
+        self.d_output = cuda.mem_alloc(self.h_output.nbytes)
+
+        self.bindings = [None] * self.engine.num_bindings
+        self.bindings[self.input_index] = int(self.d_input)
+        self.bindings[self.output_index] = int(self.d_output)
+
+    def predict(self, data):
+        ''' feeds padded sequences through the engine '''
+        h = []
+        for start in range(0, len(data), self.max_batch):
+            batch = data[start:start + self.max_batch]
+            n = len(batch)
+
+            self.h_input[:n] = batch
+            self.context.set_binding_shape(self.input_index, (n, self.maxlen))
+
+            self.cuda.memcpy_htod_async(self.d_input, self.h_input[:n], self.stream)
+            self.context.execute_async_v2(self.bindings, self.stream.handle)
+            self.cuda.memcpy_dtoh_async(self.h_output[:n], self.d_output, self.stream)
+            self.stream.synchronize()
+
+            h.append(self.h_output[:n].copy())
+
+        return np.concatenate(h)
@@ -1,13 +1,19 @@
 import string
 
 BLACK_LIST = string.punctuation.replace('%', '') + '\n'
+BLACK_LIST_TABLE = string.maketrans(BLACK_LIST, ' ' * len(BLACK_LIST))
 
 
 def normalize(text,
               black_list=BLACK_LIST,
               vocab=None, lowercase=True, tokenize=False):
     if black_list:
-        text = text.translate(string.maketrans(BLACK_LIST, ' ' * len(BLACK_LIST)))
+        # translation table for the default black list is built only once
+        if black_list == BLACK_LIST:
+            table = BLACK_LIST_TABLE
+        else:
+            table = string.maketrans(black_list, ' ' * len(black_list))
+        text = text.translate(table)
     if lowercase:
         text = text.lower()
     if vocab:
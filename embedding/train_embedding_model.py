@@ -37,10 +37,12 @@ logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s [%(levelname)s] %(message)s',)
 
+import csv
 import string
 import pickle
 
 import numpy as np
+import pandas as pd
 import tensorflow as tf
 
 from collections import Counter
@@ -120,26 +122,37 @@ def load_glove_embeddings(embedding_path, word_index,
     '''
     logger = logging.getLogger(__name__)
 
-    # create dictionary with embeddings
-    embeddings_index = {}
+    # create dictionary with embeddings, the whole file is parsed by
+    # pandas' C reader instead of splitting it line by line
     with open(embedding_path) as f:
-        for line in f:
-            word, coefs = line.split(" ", 1)
-            coefs = np.asarray(coefs.split(), dtype='float32')
-            embeddings_index[word] = coefs
+        ncolumns = len(f.readline().split(' '))
 
-    logger.debug('Found %s word vectors with shape', len(embeddings_index))
+    # vectors are parsed straight into float32
+    dtypes = {column: np.float32 for column in range(1, ncolumns)}
+    dtypes[0] = str
+
+    glove = pd.read_csv(embedding_path, sep=' ', header=None, engine='c',
+                        quoting=csv.QUOTE_NONE, na_filter=False,
+                        dtype=dtypes)
+    words = glove.iloc[:, 0].values
+    vectors = glove.iloc[:, 1:].values
+    glove_word_to_row = dict(zip(words, range(len(words))))
+
+    logger.debug('Found %s word vectors with shape', len(glove_word_to_row))
 
     # for convenience
-    nrows, ncols = len(word_index) + 1, coefs.shape[0]
+    nrows, ncols = len(word_index) + 1, vectors.shape[1]
     logger.debug("rows %s, columns %s", nrows, ncols)
 
     # words not found in embedding index will be all-zeros
     embedding_matrix = np.zeros((nrows, ncols))
-    for word, i in word_index.items():
-        embedding_vector = embeddings_index.get(word)
-        if embedding_vector is not None:
-            embedding_matrix[i] = embedding_vector
+    vocab, indexes = zip(*word_index.items())
+    rows = np.fromiter(
+        (glove_word_to_row.get(word, -1) for word in vocab),
+        dtype=np.int64, count=len(vocab))
+    indexes = np.array(indexes, dtype=np.int64)
+    found = rows >= 0
+    embedding_matrix[indexes[found]] = vectors[rows[found]]
 
     embedding_layer = Embedding(nrows,
                                 ncols,
@@ -183,6 +196,18 @@ def train_val_split(data, labels, test_size, min_count=2, seed=0):
     return x_train, y_train, x_val, y_val
 
 
+def batch_generator(data, labels, batch_size, seed=0):
+    '''
+    Yields shuffled batches indefinitely, reshuffling every epoch
+    '''
+    rng = np.random.RandomState(seed)
+    while True:
+        order = rng.permutation(len(data))
+        for start in range(0, len(data), batch_size):
+            batch = order[start:start + batch_size]
+            yield data[batch], labels[batch]
+
+
 def build_model(word_index, glove_path, max_sent, dropout_rate, nb_classes):
     logger = logging.getLogger(__name__)
 
@@ -265,13 +290,17 @@ def main(args):
         verbose=1,
         patience=int(args['--early-stopping-patience'])))
 
+    # batches are prepared by a background worker and queued ahead,
+    # so the GPU does not wait for them between steps
     logger.info('Fit that thing!')
-    model.fit(
-        x_train, y_train,
+    batch_size = int(args['--batch-size'])
+    model.fit_generator(
+        batch_generator(x_train, y_train, batch_size),
+        steps_per_epoch=int(np.ceil(len(x_train) / float(batch_size))),
         validation_data=(x_val, y_val),
         callbacks=callbacks,
         epochs=int(args['--epochs']),
-        batch_size=int(args['--batch-size']),
+        max_queue_size=10,
         verbose=int(args['--verbose']))
 
     # evalute model on train data to see how well we're fitting the data